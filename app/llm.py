@@ -1,24 +1,35 @@
 from __future__ import annotations
+from functools import lru_cache
 from typing import List, Tuple
 import re
 
 _SENT_SPLIT = re.compile(r'(?<=[.!?])\s+')
+_WORD_RE = re.compile(r"[a-z0-9']+")
+_WS_RE = re.compile(r'\s+')
 
-def _wordset(t: str) -> set[str]:
-    return set(re.findall(r"[a-z0-9']+", (t or "").lower()))
+@lru_cache(maxsize=4096)
+def _wordset(t: str) -> frozenset[str]:
+    # cached per query/sentence; frozenset so the shared cached value can't be mutated
+    return frozenset(_WORD_RE.findall((t or "").lower()))
 
 def _sentences(t: str) -> List[str]:
-    t = re.sub(r'\s+', ' ', (t or '').strip())
+    t = _WS_RE.sub(' ', (t or '').strip())
     if not t:
         return []
     return [s.strip() for s in _SENT_SPLIT.split(t) if s.strip()]
 
+@lru_cache(maxsize=256)
+def _sentences_with_tokens(chunk: str) -> Tuple[Tuple[str, frozenset[str]], ...]:
+    # the same top chunks come back across consecutive questions; split/tokenize once
+    return tuple((s, _wordset(s)) for s in _sentences(chunk))
+
 def _best_sents_for_query(query: str, chunk: str, max_sents: int = 2) -> List[str]:
     q = _wordset(query)
-    sents = _sentences(chunk)
+    if not q:
+        return []
     scored = []
-    for s in sents:
-        overlap = len(q & _wordset(s))
+    for s, toks in _sentences_with_tokens(chunk):
+        overlap = len(q & toks)
         if overlap > 0:
             scored.append((overlap, s))
     scored.sort(key=lambda x: x[0], reverse=True)
@@ -39,7 +50,7 @@ def synthesize_answer(query: str, contexts: List[str], strict: bool = True
     - return (answer, used_chunk_indices) where indices map to provided contexts order (1-based for citations)
     """
     if not strict:
-        chit = _smalltalk_or_none(query)
+        chit = smalltalk_or_none(query)
         if chit:
             return chit, []
     if not contexts:
@@ -72,20 +83,25 @@ def synthesize_answer(query: str, contexts: List[str], strict: bool = True
     cites = "".join(f"[{i}]" for i in used_idxs) if used_idxs else ""
     return (f"{fused} {cites}".strip(), used_idxs)
 
-def _smalltalk_or_none(q: str) -> str | None:
+def _phrases(*ps: str) -> str:
+    return "|".join(re.escape(p) for p in ps)
+
+# compiled once; anchors mirror the old in/startswith/endswith checks
+_GREET_RE = re.compile(rf"^(?:{_phrases('hi', 'hello', 'hey', 'hola', 'hi there', 'good morning', 'good evening')})(?: |$)")
+_HOWARE_RE = re.compile(_phrases("how are you", "how r u", "how are u", "hows it going", "how’s it going"))
+_THANKS_RE = re.compile(rf"\b(?:{_phrases('thanks', 'thank you', 'thx', 'ty', 'much appreciated')})$")
+_BYE_RE = re.compile(rf"^(?:{_phrases('bye', 'goodbye', 'see ya', 'see you', 'later', 'catch you later')})(?: |$)")
+
+def smalltalk_or_none(q: str) -> str | None:
     ql = (q or "").strip().lower()
-    greetings = {"hi", "hello", "hey", "hola", "hi there", "good morning", "good evening"}
-    thanks = {"thanks", "thank you", "thx", "ty", "much appreciated"}
-    howare = {"how are you", "how r u", "how are u", "hows it going", "how’s it going"}
-    bye = {"bye", "goodbye", "see ya", "see you", "later", "catch you later"}
 
-    if ql in greetings or any(ql.startswith(g + " ") for g in greetings):
+    if _GREET_RE.match(ql):
         return "Hey! 👋 What would you like to explore?"
-    if any(p in ql for p in howare):
+    if _HOWARE_RE.search(ql):
         return "Doing well—curious as ever. What can I help you dig into?"
-    if ql in thanks or any(ql.endswith(t) for t in thanks):
+    if _THANKS_RE.search(ql):
         return "You’re welcome!"
-    if ql in bye or any(ql.startswith(b + " ") for b in bye):
+    if _BYE_RE.match(ql):
         return "Bye! If another question pops up, I’m here."
 
     return None
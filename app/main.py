@@ -1,4 +1,13 @@
+import asyncio
+import hashlib
+import multiprocessing as mp
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import orjson
 from fastapi import FastAPI, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from pathlib import Path
@@ -6,21 +15,108 @@ from app.settings import settings
 from rag.embed import Embedder
 from rag.vectorstore import VectorStore
 from rag.retrieve import retrieve
-from app.llm import synthesize_answer
-from rag.universal_chunk import make_chunks
+from rag.rerank import warmup as warmup_reranker
+from app.llm import synthesize_answer, smalltalk_or_none
+from rag.universal_chunk import make_chunks, decode_and_chunk
 
 app = FastAPI(title="Minimal RAG API")
 
-_embedder = Embedder()  # defaults to BGE-small
+class GzipRequestMiddleware:
+    """
+    Inflate request bodies sent with `Content-Encoding: gzip` (the GUI
+    compresses large pasted texts). Starlette's GZipMiddleware only
+    handles responses. Inflation is capped at `max_size` bytes (413 past
+    that), so a small compressed body can't expand without bound.
+    """
+    def __init__(self, app, max_size: int = 32 * 1024 * 1024):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not any(
+            k.lower() == b"content-encoding" and v.strip().lower() == b"gzip"
+            for k, v in scope["headers"]
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        inflater = zlib.decompressobj(wbits=31)  # 31: expect a gzip header/trailer
+        parts, size, more = [], 0, True
+        try:
+            while more:
+                msg = await receive()
+                data = msg.get("body", b"")
+                more = msg.get("more_body", False)
+                while data and not inflater.eof:
+                    # never produce more than one byte past the cap
+                    chunk = inflater.decompress(data, self.max_size - size + 1)
+                    size += len(chunk)
+                    if size > self.max_size:
+                        await PlainTextResponse("Inflated request body too large",
+                                                status_code=413)(scope, receive, send)
+                        return
+                    parts.append(chunk)
+                    data = inflater.unconsumed_tail
+            if not inflater.eof:
+                raise zlib.error("truncated gzip stream")
+        except zlib.error:
+            await PlainTextResponse("Invalid gzip request body", status_code=400)(scope, receive, send)
+            return
+        body = b"".join(parts)
+
+        headers = [(k, v) for k, v in scope["headers"]
+                   if k.lower() not in (b"content-encoding", b"content-length")]
+        headers.append((b"content-length", str(len(body)).encode()))
+        delivered = False
+
+        async def inflated_receive():
+            nonlocal delivered
+            if delivered:
+                return await receive()
+            delivered = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        await self.app({**scope, "headers": headers}, inflated_receive, send)
+
+app.add_middleware(GzipRequestMiddleware)
+
+_embedder = Embedder(batch_size=settings.EMBED_BATCH_SIZE)  # defaults to BGE-small
 _dim = _embedder.encode_passages(["probe"]).shape[1]
 _store = VectorStore(settings.INDEX_DIR, dim=_dim)
 
+# decode+chunk is pure-Python CPU work, so fan files out to processes.
+# spawn (not fork) so workers don't inherit torch/FAISS thread state.
+_chunk_pool: ProcessPoolExecutor | None = None
+
+def _get_chunk_pool() -> ProcessPoolExecutor:
+    global _chunk_pool
+    if _chunk_pool is None:
+        _chunk_pool = ProcessPoolExecutor(mp_context=mp.get_context("spawn"))
+    return _chunk_pool
+
+@app.on_event("startup")
+def _warm_reranker():
+    # load the cross-encoder now instead of on the first /query
+    warmup_reranker()
+
+@app.on_event("shutdown")
+def _shutdown_chunk_pool():
+    if _chunk_pool is not None:
+        _chunk_pool.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("shutdown")
+def _close_store():
+    _store.close()
+
 class IngestTextReq(BaseModel):
     texts: List[str]
     doc_id: Optional[str] = None
     source: Optional[str] = "inline"
     title: Optional[str] = "Inline Document"
 
+class IngestExistsReq(BaseModel):
+    hashes: List[str]  # sha256 hex digests of raw file bytes
+
 class QueryReq(BaseModel):
     query: str
     top_k: int = settings.TOP_K
@@ -61,41 +157,61 @@ def ingest_text(req: IngestTextReq):
     _store.add(embs, metadatas)
     return {"ingested_chunks": len(chunks), "index_size": _store.size}
 
+@app.post("/ingest/exists")
+def ingest_exists(req: IngestExistsReq):
+    # lets a client skip uploading files whose exact bytes are already indexed
+    return {"exists": [h for h in req.hashes if h in _store.file_hashes]}
+
 @app.post("/ingest/files")
-def ingest_files(files: List[UploadFile] = File(...)):
+async def ingest_files(files: List[UploadFile] = File(...)):
+    raws = await asyncio.gather(*[f.read() for f in files])
+    titles = [Path(f.filename).name for f in files]
+    digests = await run_in_threadpool(lambda: [hashlib.sha256(raw).hexdigest() for raw in raws])
+
+    # universal path: decode, normalize, chunk (one worker per file)
+    loop = asyncio.get_running_loop()
+    pool = _get_chunk_pool()
+    per_file = await asyncio.gather(*[
+        loop.run_in_executor(
+            pool,
+            partial(decode_and_chunk, raw, title=title,
+                    target_tokens=180, overlap_tokens=30, max_chars=1500),
+        )
+        for raw, title in zip(raws, titles)
+    ])
+
+    # files with nothing to index are still recorded, or the UI's pre-flight would
+    # keep re-uploading them
+    empty = [digest for digest, pieces in zip(digests, per_file) if not pieces]
+    if empty:
+        await run_in_threadpool(_store.add_empty_files, empty)
+
     metadatas, chunks = [], []
-    for f in files:
-        raw = f.file.read()
-        # universal path: decode, normalize, chunk
-        try:
-            text = raw.decode("utf-8-sig", errors="ignore")
-        except Exception:
-            text = raw.decode("latin-1", errors="ignore")
-        title = Path(f.filename).name
-        for piece, meta in make_chunks(
-            text,
-            title=title,
-            target_tokens=180,
-            overlap_tokens=30,
-            max_chars=1500,
-        ):
+    for title, digest, pieces in zip(titles, digests, per_file):
+        for piece, meta in pieces:
             chunks.append(piece)
             metadatas.append({
                 **meta,
                 "doc_id": title,
                 "source": "file",
                 "title": title,
+                "sha256": digest,
             })
 
     if not chunks:
         return {"ingested_chunks": 0, "index_size": _store.size}
 
-    embs = _embedder.encode_passages(chunks)
-    _store.add(embs, metadatas)
+    # one encode call across all files -> bigger batches for the model
+    embs = await run_in_threadpool(_embedder.encode_passages, chunks)
+    await run_in_threadpool(_store.add, embs, metadatas)
     return {"ingested_chunks": len(chunks), "index_size": _store.size}
-    
-@app.post("/query")
-def query(req: QueryReq):
+
+def _answer(req: QueryReq) -> dict:
+    # chatty mode: answer greetings etc. without touching the retrieval stack
+    if not req.strict:
+        chit = smalltalk_or_none(req.query)
+        if chit:
+            return {"answer": chit, "sources": [], "strict": False}
     contexts, sources = retrieve(req.query, _embedder, _store, top_k=req.top_k)
     answer, used = synthesize_answer(req.query, contexts, strict=req.strict)
     # mark which sources were actually cited
@@ -103,3 +219,30 @@ def query(req: QueryReq):
         s["cited"] = s.get("rank") in used
     return {"answer": answer, "sources": sources, "strict": req.strict}
 
+@app.post("/query")
+def query(req: QueryReq):
+    return _answer(req)
+
+@app.post("/query/stream")
+def query_stream(req: QueryReq):
+    """
+    Server-Sent Events version of /query:
+      event: sources / data: {"sources": [...], "strict": bool}   (right after retrieval)
+      data: "<answer piece>"                                       (repeated, JSON strings)
+      event: done / data: {"cited": [rank, ...]}
+    Sources go out before synthesis runs, so the client can show them while
+    the answer is still being produced; pieces are word-sized so a generative
+    backend can slot in without changing the wire format.
+    """
+    def events():
+        chit = None if req.strict else smalltalk_or_none(req.query)
+        contexts, sources = ([], []) if chit else retrieve(req.query, _embedder, _store, top_k=req.top_k)
+        yield b"event: sources\ndata: " + orjson.dumps({"sources": sources, "strict": req.strict}) + b"\n\n"
+        answer, used = (chit, []) if chit else synthesize_answer(req.query, contexts, strict=req.strict)
+        words = answer.split(" ")
+        for i, w in enumerate(words):
+            piece = w if i == len(words) - 1 else w + " "
+            yield b"data: " + orjson.dumps(piece) + b"\n\n"
+        yield b"event: done\ndata: " + orjson.dumps({"cited": list(used)}) + b"\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
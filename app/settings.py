@@ -13,6 +13,9 @@ class Settings(BaseModel):
     CHUNK_OVERLAP: int = int(os.getenv("CHUNK_OVERLAP", "120"))
     TOP_K: int = int(os.getenv("TOP_K", "5"))
 
+    # embedding (0 = auto: 64 on CPU, 128 on CUDA)
+    EMBED_BATCH_SIZE: int = int(os.getenv("EMBED_BATCH_SIZE", "0"))
+
     # generation caps (used by extractive formatter too)
     MAX_NEW_TOKENS: int = int(os.getenv("MAX_NEW_TOKENS", "60"))
 
@@ -1,5 +1,12 @@
 from __future__ import annotations
+from collections import OrderedDict
+import os
+import threading
 import numpy as np
+
+# let the fast (Rust) tokenizer use its thread pool; respect an explicit override
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
 from sentence_transformers import SentenceTransformer
 
 # Default is BGE-small v1.5 (great on CPU). For E5 set model_name accordingly.
@@ -22,15 +29,24 @@ class Embedder:
                   passage="passage: {p}"
     - generic:    no prefixing
     Embeddings are L2-normalized (cosine).
+    Query embeddings are kept in a small in-memory LRU keyed by query text.
     """
-    def __init__(self, model_name: str = _DEFAULT, max_seq_len: int = 256):
+    def __init__(self, model_name: str = _DEFAULT, max_seq_len: int = 256,
+                 query_cache_size: int = 1024, batch_size: int | None = None):
         self.model_name = model_name
         self.family = _detect_family(model_name)
+        self._qcache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._qcache_size = query_cache_size
+        self._qcache_lock = threading.Lock()
         self.model = SentenceTransformer(model_name)
         try:
             self.model.max_seq_length = max_seq_len
         except Exception:
             pass
+        # bigger batches amortize per-call overhead; GPUs take more before saturating
+        if not batch_size:
+            batch_size = 128 if getattr(self.model.device, "type", "cpu") == "cuda" else 64
+        self.batch_size = batch_size
 
     # ----- formatting helpers -----
     def _fmt_query(self, q: str) -> str:
@@ -51,17 +67,28 @@ class Embedder:
     # ----- public encode APIs -----
     def encode_queries(self, queries: list[str]) -> np.ndarray:
         texts = [self._fmt_query(q) for q in queries]
-        emb = self.model.encode(
-            texts, normalize_embeddings=True,
-            convert_to_numpy=True, batch_size=32, show_progress_bar=False
-        )
-        return emb.astype("float32")
+        with self._qcache_lock:
+            hits = {t: self._qcache[t] for t in texts if t in self._qcache}
+        misses = [t for t in dict.fromkeys(texts) if t not in hits]
+        if misses:
+            emb = self.model.encode(
+                misses, normalize_embeddings=True,
+                convert_to_numpy=True, batch_size=self.batch_size, show_progress_bar=False
+            ).astype("float32")
+            hits.update(zip(misses, emb))
+        with self._qcache_lock:
+            for t in texts:
+                self._qcache[t] = hits[t]
+                self._qcache.move_to_end(t)
+            while len(self._qcache) > self._qcache_size:
+                self._qcache.popitem(last=False)
+        return np.stack([hits[t] for t in texts])
 
     def encode_passages(self, passages: list[str]) -> np.ndarray:
         texts = [self._fmt_passage(p) for p in passages]
         emb = self.model.encode(
             texts, normalize_embeddings=True,
-            convert_to_numpy=True, batch_size=32, show_progress_bar=False
+            convert_to_numpy=True, batch_size=self.batch_size, show_progress_bar=False
         )
         return emb.astype("float32")
 
@@ -5,19 +5,25 @@ from sentence_transformers import CrossEncoder
 
 # small & fast cross-encoder (~90MB)
 _MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+_MAX_LENGTH = 256  # chunks are ~180 tokens; longer pairs just cost more
 _model: CrossEncoder | None = None
 
 def _get_model() -> CrossEncoder:
     global _model
     if _model is None:
-        _model = CrossEncoder(_MODEL_NAME)
+        _model = CrossEncoder(_MODEL_NAME, max_length=_MAX_LENGTH)
     return _model
 
+def warmup() -> None:
+    """Load the model and run one tiny prediction so the first query doesn't pay for it."""
+    _get_model().predict([("warmup", "warmup")], show_progress_bar=False)
+
 def rerank(query: str, passages: List[str], top_k: int = 3) -> List[Tuple[float, int]]:
     if not passages:
         return []
     model = _get_model()
     pairs = [(query, p or "") for p in passages]
-    scores = model.predict(pairs, convert_to_numpy=True)  # higher is better
+    scores = model.predict(pairs, batch_size=32, show_progress_bar=False,
+                           convert_to_numpy=True)  # higher is better
     ranked = sorted([(float(s), i) for i, s in enumerate(scores)], reverse=True)[:top_k]
     return ranked
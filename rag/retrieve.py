@@ -1,9 +1,16 @@
 from __future__ import annotations
 from typing import List, Dict, Any, Tuple
+import os
 import numpy as np
-from rank_bm25 import BM25Okapi
 from rapidfuzz import fuzz
 from rag.rerank import rerank as ce_rerank
+from rag.vectorstore import bm25_tokenize
+
+# metadata kept for bookkeeping only, never returned with sources
+_PRIVATE_META = frozenset({"sha256"})
+
+# set RAG_DEBUG_NORMS=1 to verify the unit-norm assumption _mmr relies on
+_DEBUG_NORMS = os.getenv("RAG_DEBUG_NORMS", "0") == "1"
 
 def _rrf(ranks: List[List[int]], k: float = 60.0) -> Dict[int, float]:
     """
@@ -17,35 +24,42 @@ def _rrf(ranks: List[List[int]], k: float = 60.0) -> Dict[int, float]:
             fused[idx] = fused.get(idx, 0.0) + 1.0 / (k + r + 1.0)
     return fused
 
+def _topk_desc(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first (argpartition, then sort only the k)."""
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    part = np.argpartition(-scores, k)[:k]
+    return part[np.argsort(-scores[part], kind="stable")]
+
 def _mmr(query_vec: np.ndarray, cand_vecs: np.ndarray, cand_idxs: List[int],
          top_k: int, lambda_: float = 0.7) -> List[int]:
     """
     Maximal Marginal Relevance on candidate vectors.
+    Vectors are assumed L2-normalized (see Embedder), so dot product == cosine.
     Returns indices into cand_idxs in selected order.
     """
     if not cand_idxs:
         return []
+    if _DEBUG_NORMS:
+        assert abs(np.linalg.norm(query_vec) - 1) < 1e-4, "query vector is not unit-norm"
+        assert np.allclose(np.linalg.norm(cand_vecs, axis=1), 1, atol=1e-3), "candidate vectors are not unit-norm"
+    n = len(cand_idxs)
+    # one GEMM for both query sims (col 0) and the pairwise Gram matrix (cols 1..n)
+    sims = cand_vecs @ np.vstack([query_vec[None, :], cand_vecs]).T
+    q_sim, G = sims[:, 0], sims[:, 1:]
+    max_sim_to_sel = np.full(n, -np.inf, dtype=np.float32)
+    taken = np.zeros(n, dtype=bool)
     selected: List[int] = []
-    # precompute sim to query
-    q_sim = cand_vecs @ query_vec / (np.linalg.norm(cand_vecs, axis=1) * np.linalg.norm(query_vec) + 1e-8)
-    remaining = list(range(len(cand_idxs)))
-    while remaining and len(selected) < top_k:
+    while len(selected) < min(top_k, n):
         if not selected:
-            i = int(max(remaining, key=lambda j: q_sim[j]))
-            selected.append(i)
-            remaining.remove(i)
-            continue
-        def mmr_score(j):
-            sim_to_q = q_sim[j]
-            sim_to_sel = max(
-                (cand_vecs[j] @ cand_vecs[s]) /
-                (np.linalg.norm(cand_vecs[j]) * np.linalg.norm(cand_vecs[s]) + 1e-8)
-                for s in selected
-            )
-            return lambda_ * sim_to_q - (1 - lambda_) * sim_to_sel
-        j_best = max(remaining, key=mmr_score)
-        selected.append(j_best)
-        remaining.remove(j_best)
+            scores = q_sim.astype(np.float32, copy=True)
+        else:
+            scores = lambda_ * q_sim - (1 - lambda_) * max_sim_to_sel
+        scores[taken] = -np.inf
+        j = int(np.argmax(scores))
+        selected.append(j)
+        taken[j] = True
+        max_sim_to_sel = np.maximum(max_sim_to_sel, G[:, j])
     return [cand_idxs[i] for i in selected]
 
 
@@ -58,26 +72,19 @@ def retrieve(query: str, embedder, store, top_k: int = 5) -> Tuple[List[str], Li
             return [], []
 
         qv = embedder.encode_queries([query])
+        q_tokens = bm25_tokenize(query)
 
         # 1) vector candidates
-        vec_hits = store.search(qv, 24)  # [(score, meta)]
-        vec_idxs = [store.metadocs.index(h[1]) for h in vec_hits if h and h[1] in store.metadocs]
+        _, vec_ids = store.search_ids(qv, 32)  # a bit wider for ANN recall
+        vec_idxs = vec_ids[vec_ids < len(store.metadocs)].tolist()
 
         # 2) BM25, only if corpus not empty
         bm_idxs = []
-        if not getattr(store, "bm25", None):
-            tokens = []
-            for m in store.metadocs:
-                t = (m.get("text") or m.get("snippet") or "").strip().lower()
-                if t:
-                    tokens.append(t.split())
-            if tokens:
-                store.bm25 = BM25Okapi(tokens)  # type: ignore[attr-defined]
-        if getattr(store, "bm25", None):
-            toks = query.lower().split()
-            if toks:
-                bm_scores = store.bm25.get_scores(toks)  # type: ignore[attr-defined]
-                bm_idxs = [i for _, i in sorted(((float(s), i) for i, s in enumerate(bm_scores)), reverse=True)[:50]]
+        bm25 = store.ensure_bm25()
+        if bm25:
+            if q_tokens:
+                bm_scores = np.asarray(bm25.get_scores(q_tokens))
+                bm_idxs = _topk_desc(bm_scores, 50).tolist()
 
         # 3) RRF fusion
         rank_lists = []
@@ -92,8 +99,12 @@ def retrieve(query: str, embedder, store, top_k: int = 5) -> Tuple[List[str], Li
             return [], []
 
         # 4) MMR (diversify)
-        texts = [(store.metadocs[i].get("text") or store.metadocs[i].get("snippet") or "") for i in cand_idxs]
-        cand_vecs = embedder.encode_passages(texts)
+        vecs = getattr(store, "vecs", None)
+        if vecs is not None and len(vecs) == len(store.metadocs):
+            cand_vecs = vecs[cand_idxs].astype(np.float32)  # fp16 storage, fp32 math
+        else:
+            texts = [(store.metadocs[i].get("text") or store.metadocs[i].get("snippet") or "") for i in cand_idxs]
+            cand_vecs = embedder.encode_passages(texts)
         mmr_selected = _mmr(qv[0], cand_vecs, list(range(len(cand_idxs))), top_k=min(8, len(cand_idxs)), lambda_=0.7)
         chosen_idxs = [cand_idxs[i] for i in mmr_selected]
         if not chosen_idxs:
@@ -113,7 +124,7 @@ def retrieve(query: str, embedder, store, top_k: int = 5) -> Tuple[List[str], Li
             snippet = (meta.get("text") or meta.get("snippet") or "")
             contexts.append(snippet)
             sources.append({
-                **meta,
+                **{k: v for k, v in meta.items() if k not in _PRIVATE_META},
                 "rank": rank,
                 "snippet": snippet[:500],
                 "chunk_index": idx,
@@ -1,4 +1,5 @@
 from __future__ import annotations
+from itertools import islice
 from typing import List, Tuple, Dict
 import re
 import unicodedata
@@ -9,14 +10,18 @@ _SENT_SPLIT = re.compile(r'(?<=[.!?])\s+(?=[A-Z0-9"\'(])')  # cheap sentence spl
 _MD_HEADER  = re.compile(r'^\s{0,3}(#{1,6})\s+(.*)$')       # markdown-like headings
 _KV_LINE    = re.compile(r'^[^\n:]{1,40}:\s+.+$')           # "Key: Value"
 _ROW_DELIMS = [",",";","|","\t"]
+_HSPACE     = re.compile(r"[^\S\r\n]+")                      # runs of spaces/tabs, not newlines
+_NL_TRIM    = re.compile(r"[ \t]*\n[ \t]*")                   # blanks around newlines
+_WS         = re.compile(r"\s+")
+_ALPHA_TOK  = re.compile(r"[A-Za-z]{2,}")
 
 def _normalize_text(t: str) -> str:
     # Unicode normalize, strip control chars, collapse spaces but keep paragraph breaks
     t = unicodedata.normalize("NFC", t or "")
     # keep \n, \r, convert others
     t = t.replace("\x00", " ")
-    t = re.sub(r"[^\S\r\n]+", " ", t)     # collapse runs of spaces/tabs
-    t = re.sub(r"[ \t]*\n[ \t]*", "\n", t) # trim around newlines
+    t = _HSPACE.sub(" ", t)     # collapse runs of spaces/tabs
+    t = _NL_TRIM.sub("\n", t)   # trim around newlines
     return t.strip()
 
 def _approx_tokens(s: str) -> int:
@@ -51,7 +56,7 @@ def _row_like(line: str) -> str | None:
     return None
 
 def _sentences(text: str) -> List[str]:
-    text = re.sub(r'\s+', ' ', (text or '').strip())
+    text = _WS.sub(' ', (text or '').strip())
     if not text:
         return []
     return [s.strip() for s in _SENT_SPLIT.split(text) if s.strip()]
@@ -222,9 +227,32 @@ def make_chunks(
     # final de-noise: drop chunks with too few alphabetic tokens
     clean = []
     for chunk, meta in chunks:
-        alpha = re.findall(r"[A-Za-z]{2,}", chunk)
-        if len(alpha) >= 5:
+        # only need to know there are 5; stop scanning once found
+        if sum(1 for _ in islice(_ALPHA_TOK.finditer(chunk), 5)) >= 5:
             clean.append((chunk, meta))
 
     return clean
 
+def decode_and_chunk(
+    raw: bytes,
+    *,
+    title: str,
+    target_tokens: int = 180,
+    overlap_tokens: int = 30,
+    max_chars: int = 1500,
+) -> List[Tuple[str, Dict]]:
+    """
+    Decode raw upload bytes and run make_chunks. Top-level so it can be
+    shipped to a process pool worker.
+    """
+    try:
+        text = raw.decode("utf-8-sig", errors="ignore")
+    except Exception:
+        text = raw.decode("latin-1", errors="ignore")
+    return make_chunks(
+        text,
+        title=title,
+        target_tokens=target_tokens,
+        overlap_tokens=overlap_tokens,
+        max_chars=max_chars,
+    )
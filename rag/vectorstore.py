@@ -1,98 +1,326 @@
-import faiss, json, uuid
+import atexit, faiss, orjson, threading, uuid
 from pathlib import Path
 import numpy as np
-from typing import Dict, Any, List, Tuple
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Any, List, Set, Tuple, BinaryIO
 from rank_bm25 import BM25Okapi
 
+# HNSW graph params: M neighbours per node, build/search beam widths
+_HNSW_M = 32
+_HNSW_EF_CONSTRUCTION = 80
+_HNSW_EF_SEARCH = 64
+
+# rewrite the index files once this many vectors are buffered (and at exit)
+_PERSIST_EVERY = 64
+
+def _new_index(dim: int) -> faiss.Index:
+    # vectors are unit-norm, so inner product == cosine.
+    # HNSW graph over fp16 codes: half the size of float32 rows, recall on par
+    # with HNSWFlat, and no training. (int8 codes need a range fitted to real
+    # data: embedding components sit within about +/-0.15, so fixed [-1, 1]
+    # bounds leave most of the 256 levels unused and recall drops.)
+    idx = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_fp16, _HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    idx.hnsw.efConstruction = _HNSW_EF_CONSTRUCTION
+    idx.hnsw.efSearch = _HNSW_EF_SEARCH
+    return idx
+
+def _is_sq8(index: faiss.Index) -> bool:
+    return (isinstance(index, faiss.IndexHNSWSQ)
+            and faiss.downcast_index(index.storage).sq.qtype == faiss.ScalarQuantizer.QT_8bit)
+
+def bm25_tokenize(text: str) -> List[str]:
+    """The one BM25 tokenizer: lowercase once, split on whitespace. Used for docs and queries."""
+    return (text or "").lower().split()
+
+class _BM25Corpus:
+    """
+    The statistics BM25Okapi is built from (per-doc term counts, doc lengths,
+    per-term doc counts), kept up to date one added doc at a time. Building a
+    model from them only recomputes the IDF table (O(vocabulary): every IDF
+    depends on the doc count), never re-counts the whole corpus.
+    """
+    def __init__(self):
+        self.doc_freqs: List[Dict[str, int]] = []
+        self.doc_len: List[int] = []
+        self.nd: Dict[str, int] = {}  # term -> number of docs containing it
+        self.total_len = 0
+
+    def add(self, term_counts: List[Dict[str, int]]):
+        for freqs in term_counts:
+            n = sum(freqs.values())
+            self.doc_freqs.append(freqs)
+            self.doc_len.append(n)
+            self.total_len += n
+            for word in freqs:
+                self.nd[word] = self.nd.get(word, 0) + 1
+
+    def snapshot(self) -> tuple:
+        """Copies (references only for the per-doc lists) that later adds won't change."""
+        return self.doc_freqs[:], self.doc_len[:], dict(self.nd), self.total_len
+
+    @staticmethod
+    def build(doc_freqs, doc_len, nd, total_len) -> BM25Okapi | None:
+        """A BM25Okapi over a snapshot, or None if there is no vocabulary yet."""
+        if not nd:
+            return None
+        bm = BM25Okapi.__new__(BM25Okapi)  # skip __init__: it would re-count every doc
+        bm.k1, bm.b, bm.epsilon, bm.tokenizer = 1.5, 0.75, 0.25, None
+        bm.corpus_size = len(doc_freqs)
+        bm.avgdl = total_len / bm.corpus_size
+        bm.doc_freqs, bm.doc_len, bm.idf = doc_freqs, doc_len, {}
+        bm._calc_idf(nd)
+        return bm
+
+class _RWLock:
+    """Many readers or one writer; waiting writers go first so searches can't starve ingest."""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
 class VectorStore:
     def __init__(self, index_dir: Path, dim: int):
         self.index_dir = index_dir
         self.index_path = index_dir / "vectors.faiss"
         self.meta_path  = index_dir / "metadata.jsonl"
+        self.vecs_path  = index_dir / "vectors.npy"
+        # sha256 of uploaded files that produced no chunks (so have no metadata rows)
+        self.empty_files_path = index_dir / "empty_files.txt"
         self.dim = dim
 
-        self.index: faiss.Index = faiss.IndexFlatIP(dim)
+        self.index: faiss.Index = _new_index(dim)
         self.metadocs: List[Dict[str, Any]] = []
+        # unit-norm passage vectors, row i == faiss id i (used by MMR).
+        # fp16 halves RAM/disk; cosine on unit vectors loses ~1e-3 at most.
+        # Stored in a buffer that doubles when full, so add() appends in amortized
+        # O(rows added) instead of copying the whole table; `vecs` is the filled part.
+        self._vecs_buf: np.ndarray = np.zeros((0, dim), dtype="float16")
+        self._nvecs = 0
         self.bm25: BM25Okapi | None = None
+        # BM25 statistics, kept in step with metadocs; the model is rebuilt lazily from them
+        self._bm25_corpus = _BM25Corpus()
+        self._pending = 0  # vectors added since the last _persist
+        self._meta_fh: BinaryIO | None = None  # append handle, opened on first add
+        # FAISS add is not safe against concurrent searches (the API ingests files in
+        # parallel threads), but searches are safe against each other: adds take the
+        # write side, searches and snapshots the read side
+        self._lock = _RWLock()
+        self._version = 0  # bumped by every add; tells ensure_bm25 whether its build is current
+        # sha256 of every uploaded file already ingested (with or without chunks)
+        self.file_hashes: Set[str] = set()
 
         self._load()
+        atexit.register(self.close)
 
     def _load(self):
         if self.index_path.exists():
+            # indexes written before the HNSW switch load as IndexFlatIP and keep working
             self.index = faiss.read_index(str(self.index_path))
+            if isinstance(self.index, faiss.IndexHNSW):
+                self.index.hnsw.efSearch = _HNSW_EF_SEARCH
 
+        # the file is rewritten from metadocs whenever it doesn't hold exactly one
+        # parseable line per faiss id; appends after a torn or skipped line would
+        # otherwise land on the wrong ids
+        rewrite = False
         if self.meta_path.exists():
-            with self.meta_path.open("r", encoding="utf-8", errors="ignore") as f:
+            with self.meta_path.open("rb") as f:
                 for line in f:
-                    line = line.rstrip("\n")
+                    # a crash mid-flush can leave a partial last line (no newline): dropped
+                    complete = line.endswith(b"\n")
+                    rewrite |= not complete
+                    line = line.rstrip(b"\r\n")
                     if not line:
                         continue
                     try:
-                        self.metadocs.append(json.loads(line))
-                    except json.JSONDecodeError:
-                        continue
+                        self.metadocs.append(orjson.loads(line))
+                    except orjson.JSONDecodeError:
+                        rewrite = True
+                        if complete:
+                            self.metadocs.append({})  # keep later records on their ids
 
         # align lengths
         n = int(self.index.ntotal)
         if len(self.metadocs) > n:
+            # metadata outlived unflushed vectors (e.g. a crash); drop the tail
             self.metadocs = self.metadocs[:n]
+            rewrite = True
         elif len(self.metadocs) < n:
             self.metadocs.extend({} for _ in range(n - len(self.metadocs)))
+            rewrite = True
+        if rewrite:
+            with self.meta_path.open("wb") as f:
+                for m in self.metadocs:
+                    f.write(orjson.dumps(m) + b"\n")
+
+        # passage vectors side-table; rebuild from the index if missing/stale
+        if self.vecs_path.exists():
+            self.vecs = np.load(self.vecs_path).astype("float16", copy=False)
+        if self.vecs.shape[0] != n:
+            self.vecs = (self.index.reconstruct_n(0, n).astype("float16") if n
+                         else np.zeros((0, self.dim), dtype="float16"))
+
+        if _is_sq8(self.index):
+            # written with the old int8 quantizer (trained on [-1, 1], poor recall):
+            # rebuild once from the side-table
+            self.index = _new_index(self.dim)
+            if n:
+                self.index.add(self.vecs.astype("float32"))
+            self._persist()
 
-        # build BM25
-        tokens = []
-        for m in self.metadocs:
-            t = (m.get("text") or m.get("snippet") or "").strip().lower()
-            tokens.append(t.split())
-        if tokens:
-            self.bm25 = BM25Okapi(tokens)
+        # count terms once; BM25 itself is built on first lexical query
+        self._bm25_corpus.add([self._term_counts(m) for m in self.metadocs])
+        self.file_hashes = {m["sha256"] for m in self.metadocs if m.get("sha256")}
+        if self.empty_files_path.exists():
+            self.file_hashes.update(h for h in self.empty_files_path.read_text().split() if len(h) == 64)
+
+    @property
+    def vecs(self) -> np.ndarray:
+        return self._vecs_buf[:self._nvecs]
+
+    @vecs.setter
+    def vecs(self, arr: np.ndarray):
+        self._vecs_buf = arr
+        self._nvecs = arr.shape[0]
+
+    def _append_vecs(self, rows: np.ndarray):
+        n, k = self._nvecs, rows.shape[0]
+        if n + k > self._vecs_buf.shape[0]:
+            grown = np.empty((max(n + k, 2 * self._vecs_buf.shape[0], 64), self.dim), dtype="float16")
+            grown[:n] = self._vecs_buf[:n]
+            self._vecs_buf = grown
+        self._vecs_buf[n:n + k] = rows
+        # publish the rows only after they are written; views handed out earlier stay valid
+        self._nvecs = n + k
+
+    def _meta_handle(self) -> BinaryIO:
+        if self._meta_fh is None:
+            self.meta_path.parent.mkdir(parents=True, exist_ok=True)
+            self._meta_fh = self.meta_path.open("ab", buffering=1 << 20)
+        return self._meta_fh
 
     def _persist(self):
+        # caller holds the write lock (or is still in __init__)
+        # metadata first, so on disk it is never shorter than the index
+        if self._meta_fh is not None:
+            self._meta_fh.flush()
         self.index_dir.mkdir(parents=True, exist_ok=True)
         faiss.write_index(self.index, str(self.index_path))
+        np.save(self.vecs_path, self.vecs)
+        self._pending = 0
+
+    def flush(self):
+        """Write buffered vectors to disk, if any."""
+        with self._lock.write():
+            if self._pending:
+                self._persist()
+
+    def close(self):
+        """Flush and release the metadata handle."""
+        with self._lock.write():
+            if self._pending:
+                self._persist()
+            if self._meta_fh is not None:
+                self._meta_fh.close()
+                self._meta_fh = None
 
     def add(self, embeddings: np.ndarray, metadatas: List[Dict[str, Any]]):
         assert embeddings.shape[0] == len(metadatas)
-        # persist metadata
-        self.meta_path.parent.mkdir(parents=True, exist_ok=True)
-        with self.meta_path.open("a", encoding="utf-8") as f:
-            for m in metadatas:
-                m.setdefault("chunk_id", str(uuid.uuid4()))
-                if isinstance(m.get("text"), str):
-                    m["text"] = m["text"][:1500]
-                f.write(json.dumps(m, ensure_ascii=False) + "\n")
-                self.metadocs.append(m)
-
-        # add vectors and persist
-        self.index.add(embeddings.astype("float32"))
-        self._persist()
-
-        # rebuild bm25
-        corpus = []
-        for md in self.metadocs:
-            t = (md.get("text") or md.get("snippet") or "").strip().lower()
-            corpus.append(t.split())
-        if corpus:
-            self.bm25 = BM25Okapi(corpus)
-
-    def search(self, qvec: np.ndarray, k: int) -> List[Tuple[float, Dict[str, Any]]]:
-        if self.index.ntotal == 0:
-            return []
-        D, I = self.index.search(qvec.astype("float32"), k)
-        out: List[Tuple[float, Dict[str, Any]]] = []
-        for score, idx in zip(D[0], I[0]):
-            if idx == -1: continue
-            meta = self.metadocs[idx] if idx < len(self.metadocs) else {}
-            out.append((float(score), meta))
-        return out
-
-    def lexical_topk(self, query: str, k: int) -> List[Tuple[float, int]]:
-        if not self.bm25:
-            return []
-        toks = query.lower().split()
-        scores = self.bm25.get_scores(toks)
-        top = sorted([(float(s), i) for i, s in enumerate(scores)], reverse=True)[:k]
-        return top
+        embeddings = embeddings.astype("float32")
+        # per-doc prep touches no shared state, so it stays outside the lock
+        for m in metadatas:
+            m.setdefault("chunk_id", str(uuid.uuid4()))
+            if isinstance(m.get("text"), str):
+                m["text"] = m["text"][:1500]
+        lines = b"".join(orjson.dumps(m) + b"\n" for m in metadatas)  # UTF-8, like ensure_ascii=False
+        term_counts = [self._term_counts(m) for m in metadatas]
+
+        with self._lock.write():
+            # persist metadata (buffered; flushed together with the index)
+            self._meta_handle().write(lines)
+            self.metadocs.extend(metadatas)
+            self.file_hashes.update(m["sha256"] for m in metadatas if m.get("sha256"))
+
+            # add vectors; the index is rewritten in batches, not on every add
+            self.index.add(embeddings)
+            self._append_vecs(embeddings)
+            self._pending += len(embeddings)
+            if self._pending >= _PERSIST_EVERY:
+                self._persist()
+
+            # only the new docs are counted; the next lexical query refreshes the IDFs
+            self._bm25_corpus.add(term_counts)
+            self.bm25 = None
+            self._version += 1
+
+    def add_empty_files(self, digests: List[str]):
+        """Remember files that yielded no chunks, so re-uploads of them can be skipped too."""
+        with self._lock.write():
+            new = [d for d in digests if d not in self.file_hashes]
+            if new:
+                self.index_dir.mkdir(parents=True, exist_ok=True)
+                with self.empty_files_path.open("a") as f:
+                    # leading newline: a torn last line from a crash can't swallow these
+                    f.write("\n" + "\n".join(new) + "\n")
+                self.file_hashes.update(new)
+
+    @staticmethod
+    def _term_counts(meta: Dict[str, Any]) -> Dict[str, int]:
+        return Counter(bm25_tokenize(meta.get("text") or meta.get("snippet") or ""))
+
+    def ensure_bm25(self) -> BM25Okapi | None:
+        """Refresh BM25 from the running corpus statistics if docs were added since the last build."""
+        with self._lock.read():
+            bm25 = self.bm25
+            if bm25 is not None:
+                return bm25
+            version, snap = self._version, self._bm25_corpus.snapshot()
+        # the IDF pass runs unlocked, so searches and ingests carry on meanwhile
+        bm25 = _BM25Corpus.build(*snap)
+        with self._lock.write():
+            if self._version == version:  # otherwise an add landed; let the next query rebuild
+                self.bm25 = bm25
+        return bm25
+
+    def search_ids(self, qvec: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Raw FAISS hits for the first query row as (scores, ids), best first, -1 padding removed."""
+        with self._lock.read():  # concurrent searches don't block each other
+            if self.index.ntotal == 0:
+                return np.empty(0, dtype="float32"), np.empty(0, dtype="int64")
+            D, I = self.index.search(qvec.astype("float32"), k)
+        keep = I[0] != -1
+        return D[0][keep], I[0][keep]
 
     @property
     def size(self) -> int:
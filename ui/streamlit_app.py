@@ -1,68 +1,277 @@
-import os, requests, streamlit as st
+import hashlib, os, time, orjson, requests, streamlit as st
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 API_URL = os.getenv("API_URL", "http://localhost:8000")
+HEALTH_URL = f"{API_URL}/health"
+INGEST_FILES_URL = f"{API_URL}/ingest/files"
+INGEST_TEXT_URL = f"{API_URL}/ingest/text"
+INGEST_EXISTS_URL = f"{API_URL}/ingest/exists"
+QUERY_STREAM_URL = f"{API_URL}/query/stream"
+# fail fast if the API isn't there; reads may legitimately take a while
+CONNECT_TIMEOUT = 1.0
+JSON_HEADERS = {"Content-Type": "application/json"}
+GZIP_MIN_BYTES = 16_384  # below this, compressing costs more than it saves
+# what safe_request reports instead of raising: transport/HTTP errors and undecodable bodies
+API_ERRORS = (requests.exceptions.RequestException, ValueError)
+# must stay below Streamlit's server.maxUploadSize (200 MB), or Streamlit rejects the
+# file first and this check never fires; 50 MB is also what one /ingest/files call handles comfortably
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "50"))
+MAX_UPLOAD_BYTES = MAX_UPLOAD_MB * 1_048_576
+POOL_MAXSIZE = 16
+# concurrent per-file ingest POSTs; kept within the pool so no socket is opened and thrown away
+INGEST_WORKERS = min(8, POOL_MAXSIZE)
+API_DOWN_MSG = "API is not available yet. Please wait a moment and try again."
+BREAKER_SECONDS = 3.0  # after a connect failure/timeout, skip the network for this long
+QUERY_CACHE_TTL = 300.0  # seconds a repeated (query, top_k, strict) answer is reused
+QUERY_CACHE_MAX = 64
 
 st.set_page_config(page_title="Minimal RAG - GUI", layout="wide")
 st.title("Minimal RAG - GUI")
 
-def safe_request(method: str, path: str, **kwargs):
-    url = f"{API_URL}{path}"
+@st.cache_resource
+def _session() -> requests.Session:
+    # one keep-alive pool shared by every rerun/session instead of a new socket per call
+    s = requests.Session()
+    # transient failures are retried here with backoff instead of by the user re-clicking.
+    # read=0 everywhere: a POST that timed out mid-read may already have been handled.
+    # /health and /query are safe to resend, so 502/503/504 are retried for them too
+    retry = Retry(total=3, connect=2, read=0, backoff_factor=0.2,
+                  status_forcelist=[502, 503, 504], allowed_methods=frozenset(["GET", "POST"]),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    # ingest POSTs: a 502/504 from a proxy can arrive after the API already indexed the
+    # body, so only refused connections (nothing sent yet) are retried. requests picks
+    # the longest matching mount prefix, so this wins for every /ingest/* URL
+    ingest_retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2,
+                         raise_on_status=False)
+    s.mount(f"{API_URL}/ingest/", HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE,
+                                             max_retries=ingest_retry))
+    return s
+
+# resolved on the script thread each rerun (same pooled object), so worker threads
+# below can use it without touching Streamlit's cache machinery
+SESSION = _session()
+# per-browser-session circuit breaker; a plain dict so ingest worker threads can trip it too
+BREAKER = st.session_state.setdefault("api_breaker", {"down_until": 0.0})
+
+def _api_down() -> bool:
+    return time.monotonic() < BREAKER["down_until"]
+
+def _is_down_error(e: Exception) -> bool:
+    # only a failed connect means the API is gone; a ReadTimeout is a slow query or
+    # ingest on a live API and must not block the next calls
+    return isinstance(e, (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError))
+
+def _note_failure(e: Exception) -> None:
+    if _is_down_error(e):
+        BREAKER["down_until"] = time.monotonic() + BREAKER_SECONDS
+
+def json_body(payload: dict) -> tuple[bytes, dict]:
+    """orjson-encode a payload; gzip it (level 1: fast, most of the ratio on text) when large."""
+    body = orjson.dumps(payload)
+    if len(body) > GZIP_MIN_BYTES:
+        import gzip  # only large pastes need it; keep it off the cold-start path
+        return gzip.compress(body, compresslevel=1), {**JSON_HEADERS, "Content-Encoding": "gzip"}
+    return body, JSON_HEADERS
+
+def _error_message(e: Exception) -> str:
+    if isinstance(e, requests.exceptions.ConnectionError):
+        return API_DOWN_MSG
+    if isinstance(e, requests.exceptions.Timeout):
+        return "Request timed out. The API might be starting up-try again shortly."
+    if isinstance(e, requests.exceptions.HTTPError):
+        return f"API returned an error ({e.response.status_code}). Please retry soon."
+    if isinstance(e, ValueError):
+        return "API sent a response that could not be read. Try again shortly."
+    return "Unexpected error talking to the API. Try again shortly."
+
+def _send(send, url: str, *, connect_timeout: float = CONNECT_TIMEOUT,
+          read_timeout: float = 10.0, **kwargs):
+    """One request, no breaker involved; returns (json, None) or (None, exception)."""
     try:
-        resp = requests.request(method, url, timeout=kwargs.pop("timeout", 10), **kwargs)
+        resp = send(url, timeout=(connect_timeout, read_timeout), **kwargs)
         resp.raise_for_status()
-        return resp.json(), None
-    except requests.exceptions.ConnectionError:
-        return None, "API is not available yet. Please wait a moment and try again."
-    except requests.exceptions.Timeout:
-        return None, "Request timed out. The API might be starting up-try again shortly."
-    except requests.exceptions.HTTPError as e:
-        return None, f"API returned an error ({e.response.status_code}). Please retry soon."
-    except Exception:
-        return None, "Unexpected error talking to the API. Try again shortly."
+        return orjson.loads(resp.content), None  # bytes straight in, no charset sniffing
+    except API_ERRORS as e:
+        return None, e
+
+def safe_request(send, url: str, **kwargs):
+    """Call SESSION.get/SESSION.post on a prebuilt URL; returns (json, None) or (None, error message)."""
+    if _api_down():
+        return None, API_DOWN_MSG
+    data, e = _send(send, url, **kwargs)
+    if e is not None:
+        _note_failure(e)
+        return None, _error_message(e)
+    return data, None
+
+def stream_answer(payload: dict, meta: dict, on_sources=None):
+    """
+    Yield answer pieces from /query/stream as they arrive (for st.write_stream).
+    The `sources` event (sent right after retrieval) fills `meta` and is handed to
+    on_sources(meta) at once; the closing `done` event adds `cited`.
+    """
+    headers = {**JSON_HEADERS, "Accept": "text/event-stream"}
+    with SESSION.post(QUERY_STREAM_URL, data=orjson.dumps(payload),
+                      headers=headers, stream=True, timeout=(CONNECT_TIMEOUT, 60)) as resp:
+        resp.raise_for_status()
+        event = "message"
+        # chunk_size=None: hand over bytes as soon as they arrive, no 512B buffering
+        for line in resp.iter_lines(chunk_size=None):
+            if not line:
+                event = "message"
+            elif line.startswith(b"event:"):
+                event = line[6:].strip().decode()
+            elif line.startswith(b"data:"):
+                data = orjson.loads(line[5:])
+                if event == "sources":
+                    meta.update(data)
+                    if on_sources:
+                        on_sources(meta)
+                elif event == "done":
+                    meta["cited"] = data["cited"]
+                    for s in meta.get("sources", []):
+                        s["cited"] = s.get("rank") in data["cited"]
+                else:
+                    yield data
+
+# sha256 per upload, so reruns don't rehash; file_id is unique to one uploaded copy.
+# Pruned to the uploader's current files every rerun, so it never outgrows them
+DIGESTS = st.session_state.setdefault("upload_digests", {})
+
+# (query, top_k, strict, index_size) -> (stored_at, answer, meta); index_size changes on
+# every ingest, so new documents never get answered from a stale entry
+QUERY_CACHE = st.session_state.setdefault("query_cache", {})
+
+def file_digest(f) -> str:
+    if f.file_id not in DIGESTS:
+        DIGESTS[f.file_id] = hashlib.sha256(f.getbuffer()).hexdigest()  # memoryview, no copy
+    return DIGESTS[f.file_id]
+
+def show_sources(area, data: dict):
+    area.caption(f"Mode: {'Strict (context-only)' if data.get('strict') else 'Chatty (non-strict)'}")
+    # one element for the whole list instead of a websocket message + DOM patch per source
+    lines = [f"[{i}] {s.get('doc_id') or s.get('source') or 'doc'}: {s.get('snippet','')}"
+             for i, s in enumerate(data.get("sources", []), 1)]
+    area.markdown("### Sources\n\n" + "\n\n".join(lines))
+
+@st.cache_data(ttl=5, show_spinner=False)
+def _get_health():
+    # every widget interaction reruns the script; collapse those into one poll per 5s.
+    # Shared by all sessions, so it only ever caches a real probe: the per-session
+    # breaker is checked by the caller, never in here
+    data, e = _send(SESSION.get, HEALTH_URL)
+    return data, (_error_message(e) if e else None), (e is not None and _is_down_error(e))
 
 with st.sidebar:
     st.header("Status")
-    h, err = safe_request("GET", "/health")
+    if _api_down():
+        h, err = None, API_DOWN_MSG
+    else:
+        h, err, down = _get_health()
+        if down:
+            BREAKER["down_until"] = time.monotonic() + BREAKER_SECONDS
     if h:
         st.success(f"API OK · index_size={h.get('index_size')} · llm_ready={h.get('llm_ready')}")
     else:
         st.info(err or "API not reachable yet. Waiting…")
+        if st.button("Retry now"):
+            BREAKER["down_until"] = 0.0
+            _get_health.clear()
+            st.rerun()
 
 st.subheader("Ingest")
 tab1, tab2 = st.tabs(["Upload files", "Paste text"])
 
 with tab1:
     files = st.file_uploader("Add documents to your knowledge base", type=None, accept_multiple_files=True)
-    if st.button("Ingest uploaded files", type="primary", disabled=not files):
-        files_payload = [("files", (f.name, f.getvalue(), "application/octet-stream")) for f in files]
-        data, err = safe_request("POST", "/ingest/files", files=files_payload, timeout=120)
-        if data: st.success(f"Ingested {data['ingested_chunks']} chunks. Index size: {data['index_size']}.")
-        else:    st.info(err)
+    for stale in DIGESTS.keys() - {f.file_id for f in files}:
+        del DIGESTS[stale]
+    # check sizes here so oversized files are never shipped on to the API
+    oversized = [f.name for f in files if f.size > MAX_UPLOAD_BYTES]
+    if oversized:
+        st.error(f"Files exceed {MAX_UPLOAD_MB} MB: {', '.join(oversized)}")
+    if st.button("Ingest uploaded files", type="primary", disabled=not files or bool(oversized)):
+        # one POST per file, in flight together: total time ~ slowest file, not the sum.
+        def _ingest_one(f):
+            return safe_request(SESSION.post, INGEST_FILES_URL,
+                                files=[("files", (f.name, f.getvalue(), "application/octet-stream"))],
+                                read_timeout=120)
+        # pre-flight: only send files whose bytes aren't indexed yet (or repeated in this batch).
+        # if the check itself fails, fall through and upload everything
+        by_digest = {}
+        for f in files:
+            by_digest.setdefault(file_digest(f), f)
+        known, _ = safe_request(SESSION.post, INGEST_EXISTS_URL,
+                                data=orjson.dumps({"hashes": list(by_digest)}), headers=JSON_HEADERS)
+        present = set(known["exists"]) if known else set()
+        todo = [f for d, f in by_digest.items() if d not in present]
+        skipped = [f.name for d, f in by_digest.items() if d in present]
+        if skipped:
+            st.info(f"Already indexed, skipped: {', '.join(skipped)}")
+        results = []
+        if todo:
+            with ThreadPoolExecutor(max_workers=min(INGEST_WORKERS, len(todo))) as ex:
+                results = list(ex.map(_ingest_one, todo))
+        ok = [d for d, _ in results if d]
+        if ok:
+            _get_health.clear()  # index_size moved; refresh it (and the query cache key) now
+            st.success(f"Ingested {sum(d['ingested_chunks'] for d in ok)} chunks from {len(ok)} file(s). "
+                       f"Index size: {max(d['index_size'] for d in ok)}.")
+        for f, (d, err) in zip(todo, results):
+            if not d: st.info(f"{f.name}: {err}")
 
 with tab2:
-    doc_id = st.text_input("Document ID (optional)", "inline")
-    text_input = st.text_area("Paste text here", height=180, placeholder="My name is Nauman...")
-    if st.button("Ingest pasted text", disabled=not text_input.strip()):
+    # a form only reruns on submit, not on every keystroke in the text area
+    with st.form("paste_form", clear_on_submit=False):
+        doc_id = st.text_input("Document ID (optional)", "inline")
+        text_input = st.text_area("Paste text here", height=180, placeholder="My name is Nauman...")
+        paste_submitted = st.form_submit_button("Ingest pasted text")
+    if paste_submitted and text_input.strip():
         payload = {"texts": [text_input], "doc_id": doc_id or None, "source": "inline"}
-        data, err = safe_request("POST", "/ingest/text", json=payload, timeout=60)
-        if data: st.success(f"Ingested {data['ingested_chunks']} chunks. Index size: {data['index_size']}.")
-        else:    st.info(err)
+        body, headers = json_body(payload)
+        data, err = safe_request(SESSION.post, INGEST_TEXT_URL, data=body, headers=headers, read_timeout=60)
+        if data:
+            _get_health.clear()
+            st.success(f"Ingested {data['ingested_chunks']} chunks. Index size: {data['index_size']}.")
+        else:
+            st.info(err)
 
 st.subheader("Query")
-query = st.text_input("Ask a question", "")
-top_k = st.slider("Top-K", 1, 10, 5)
-strict_mode = st.toggle("Strict (context-only) answers", value=True, help="When on, answers must be supported by your indexed documents. When off, small-talk is allowed and answers fall back to best-effort.")
+with st.form("query_form", clear_on_submit=False):
+    query = st.text_input("Ask a question", "")
+    top_k = st.slider("Top-K", 1, 10, 5)
+    strict_mode = st.toggle("Strict (context-only) answers", value=True, help="When on, answers must be supported by your indexed documents. When off, small-talk is allowed and answers fall back to best-effort.")
+    submitted = st.form_submit_button("Search & Answer", type="primary")
 
-if st.button("Search & Answer", type="primary", disabled=not query.strip()):
+if submitted and query.strip():
     payload = {"query": query, "top_k": top_k, "strict": strict_mode}  # <-- send strict flag
-    data, err = safe_request("POST", "/query", json=payload, timeout=60)
-    if data:
+    key = (query, top_k, strict_mode, h.get("index_size") if h else None)
+    hit = QUERY_CACHE.get(key)
+    if hit and time.monotonic() - hit[0] < QUERY_CACHE_TTL:
         st.markdown("### Answer")
-        st.code((data.get("answer") or "").strip(), language="markdown")
-        st.caption(f"Mode: {'Strict (context-only)' if data.get('strict') else 'Chatty (non-strict)'}")
-        st.markdown("### Sources")
-        for i, s in enumerate(data.get("sources", []), 1):
-            doc = s.get("doc_id") or s.get("source") or "doc"
-            st.write(f"[{i}] {doc}: {s.get('snippet','')}")
+        st.markdown(hit[1])
+        show_sources(st.container(), hit[2])
+    elif _api_down():
+        st.info(API_DOWN_MSG)
     else:
-        st.info(err)
+        data = {}
+        st.markdown("### Answer")
+        # sources arrive before the answer; they are drawn below it as soon as they do
+        answer_area, sources_area = st.container(), st.container()
+        try:
+            answer = answer_area.write_stream(
+                stream_answer(payload, data, on_sources=lambda m: show_sources(sources_area, m)))
+        except API_ERRORS as e:
+            _note_failure(e)
+            st.info(_error_message(e))
+        else:
+            if "cited" in data:  # only complete answers (the done event arrived) are reused
+                QUERY_CACHE.pop(key, None)
+                QUERY_CACHE[key] = (time.monotonic(), answer, data)
+                while len(QUERY_CACHE) > QUERY_CACHE_MAX:
+                    QUERY_CACHE.pop(next(iter(QUERY_CACHE)))